@@ -19,13 +19,15 @@ admin = Blueprint('admin', __name__)
 @admin.route('/')
 async def home():
 
+    user_data = session.get('user_data')
+
     # if not authenticated; render login
-    if not 'authenticated' in session:
+    if not user_data:
         return await flash('error', 'You must be logged in to access the admin panel!', 'login')
     
     # if authenticated but not staff; render home
-    elif not session['user_data']['priv'] & Privileges.Staff:
-        return await flash('error', f'Hey! You don\'t have enough clearance to access the admin panel {session["user_data"]["name"]}!', 'home')
+    elif not user_data['priv'] & Privileges.Staff:
+        return await flash('error', f'Hey! You don\'t have enough clearance to access the admin panel {user_data["name"]}!', 'home')
     
     # fetch data from database
     dash_data = await glob.db.fetch('SELECT COUNT(id) AS count, '
@@ -1,18 +1,23 @@
 # -*- coding: utf-8 -*-
 
+import argon2
 import asyncio
+import ipaddress
+import os
 import re
 import time
 import bcrypt
 import hashlib
 import markdown2
+from binascii import hexlify
+from concurrent.futures import ThreadPoolExecutor
 from geoip import geolite2
 from quart import Blueprint, render_template, redirect, request, session
 from cmyui import log, Ansi
 
 from objects import glob
 from objects.privileges import Privileges
-from objects.utils import flash, get_safe_name
+from objects.utils import bcrypt_cache_tag, flash, get_safe_name, requires_auth
 
 __all__ = ()
 
@@ -24,73 +29,174 @@ valid_mods = frozenset({'vn', 'rx', 'ap'})
 valid_sorts = frozenset({'tscore', 'rscore', 'pp', 'plays',
                         'playtime', 'acc', 'maxcombo'})
 
+# (mode, mods) pairs gulag keeps stats for;
+# relax has no mania & autopilot is std only.
+valid_profile_modes = frozenset({
+    ('std', 'vn'), ('taiko', 'vn'), ('catch', 'vn'), ('mania', 'vn'),
+    ('std', 'rx'), ('taiko', 'rx'), ('catch', 'rx'),
+    ('std', 'ap')
+})
+
+""" debug helpers """
+# bound once at import so handlers don't
+# need to check the debug config per request.
+_debug = glob.config.debug
+if _debug:
+    now_ns = time.time_ns
+    log_debug = log
+else:
+    now_ns = lambda: 0
+    log_debug = lambda *args, **kwargs: None
+
+""" load geoip database """
+@frontend.before_app_serving
+async def load_geoip() -> None:
+    # the database is loaded lazily on first lookup;
+    # do it at startup rather than on a user's registration.
+    geolite2.get_info()
+
+""" bcrypt cache lifetime (seconds) """
+BCRYPT_CACHE_TTL = 5 * 60
+
+""" password hashing """
+_argon2 = argon2.PasswordHasher(time_cost=3, memory_cost=65536, parallelism=2)
+# configs copied from older samples won't have this option
+_use_argon2 = getattr(glob.config, 'argon2', False)
+_pw_upgrades = set() # strong refs to running rehash tasks
+
+# each argon2id hash/verify allocates 64MiB (memory_cost);
+# run them on a small dedicated pool to bound total memory.
+ARGON2_MAX_WORKERS = 2
+_argon2_executor = ThreadPoolExecutor(max_workers=ARGON2_MAX_WORKERS,
+                                      thread_name_prefix='argon2')
+
+def hash_pw(pw_md5: bytes) -> bytes:
+    """ Hashes a password's md5 with argon2id if enabled, otherwise bcrypt. """
+    if _use_argon2:
+        return _argon2.hash(pw_md5).encode()
+
+    return bcrypt.hashpw(pw_md5, bcrypt.gensalt())
+
+def check_pw(pw_md5: bytes, pw_hash: bytes) -> bool:
+    """ Checks a password's md5 against an argon2id or (legacy) bcrypt hash. """
+    if pw_hash.startswith(b'$argon2'):
+        try:
+            return _argon2.verify(pw_hash, pw_md5)
+        except (argon2.exceptions.VerificationError,
+                argon2.exceptions.InvalidHash):
+            return False
+
+    return bcrypt.checkpw(pw_md5, pw_hash)
+
+async def upgrade_pw(user_id: int, pw_md5: bytes, pw_tag: bytes, old_hash: bytes) -> None:
+    """ Rehashes a user's legacy bcrypt password with argon2id. """
+    try:
+        loop = asyncio.get_running_loop()
+        pw_hash = await loop.run_in_executor(_argon2_executor, hash_pw, pw_md5)
+
+        # only replace the hash we verified; if the password
+        # changed in the meantime, leave the new one alone.
+        async with glob.db.pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(
+                    'UPDATE users SET pw_bcrypt = %s '
+                    'WHERE id = %s AND pw_bcrypt = %s',
+                    [pw_hash, user_id, old_hash]
+                )
+                updated = cursor.rowcount
+            await conn.commit()
+    except Exception as exc:
+        log(f'Failed to upgrade user {user_id}\'s password hash: {exc!r}', Ansi.LRED)
+        return
+
+    if not updated:
+        return
+
+    # keep the cache valid for the new hash
+    glob.cache['bcrypt'][pw_tag] = (time.time() + BCRYPT_CACHE_TTL, pw_hash)
+
+    log_debug(f'Upgraded user {user_id}\'s password hash to argon2id.', Ansi.LGREEN)
+
+""" rendered template & docs caches """
+_rendered = {}
+_docs = {} # {name: (mtime, html)}
+async def render_cached(key, template: str, **context) -> str:
+    """ Renders a template once for anonymous users, serving the cached page after. """
+    # pages for logged in users depend on their session (navbar etc.),
+    # and debug mode may reload templates; always render those.
+    if 'user_data' in session or _debug:
+        return await render_template(template, **context)
+
+    if key not in _rendered:
+        _rendered[key] = await render_template(template, **context)
+
+    return _rendered[key]
+
 """ home """
 @frontend.route('/home') # GET
 @frontend.route('/')
 async def home():
-    return await render_template('home.html')
+    return await render_cached('home', 'home.html')
 
 """ settings """
 @frontend.route('/settings') # GET
-async def settings():
-    # if not authenticated; render login
-    if not 'authenticated' in session:
-        return await flash('error', 'You must be logged in to access user settings!', 'login')
-
+@requires_auth('You must be logged in to access user settings!')
+async def settings(user_data):
     # TODO: user settings page
     NotImplemented
 
     return await render_template('settings.html')
 
-@frontend.route('/u/<user>') # GET
+@frontend.route('/u/<int:user>') # GET
 async def profile(user):
-    mode = request.args.get('mode', type=str)
-    mods = request.args.get('mods', type=str)
-    
-    if mods:
-        if mods not in valid_mods:
-            return b'invalid mods! (vn, rx, ap)'
-    else:
-        mods = 'vn'
-    if mode:
-        if mode not in valid_modes:
-            return b'invalid mode! (std, taiko, catch, mania)'
-    else:
-        mode = 'std'
+    mode = request.args.get('mode', type=str) or 'std'
+    mods = request.args.get('mods', type=str) or 'vn'
 
-    userdata = await glob.db.fetch(f'SELECT name, id, priv, country FROM users WHERE id = {user}')
+    if (mode, mods) not in valid_profile_modes:
+        return b'invalid mode/mods combination!', 400
 
-    # don't display profile if user is banned
-    if not userdata or \
-    userdata and userdata['priv'] < 3 and not 'authenticated' in session or \
-    userdata and userdata['priv'] < 3 and 'authenticated' in session and not session['user_data']['priv'] & Privileges.Staff:  
-        return await render_template('404.html')
+    userdata = await glob.db.fetch(
+        'SELECT name, id, priv, country '
+        'FROM users WHERE id = %s',
+        [user]
+    )
+
+    # don't display profile if user is banned (unless we're staff)
+    session_data = session.get('user_data')
+    priv = session_data['priv'] if session_data else 0
+    if not userdata or (userdata['priv'] < 3 and not priv & Privileges.Staff):
+        return await render_cached('404', '404.html'), 404
 
     return await render_template('profile.html', user=userdata, mode=mode, mods=mods)
 
 """ leaderboard """
 @frontend.route('/leaderboard') # GET
 async def leaderboard_nodata():
-    return await render_template('leaderboard.html', mode='std', sort='pp', mods='vn')
+    return await leaderboard('std', 'pp', 'vn')
 @frontend.route('/leaderboard/<mode>/<sort>/<mods>') # GET
 async def leaderboard(mode, sort, mods):
-    return await render_template('leaderboard.html', mode=mode, sort=sort, mods=mods)
+    # validate args first; they're part of the cache key
+    if mode not in valid_modes or sort not in valid_sorts or mods not in valid_mods:
+        return await render_cached('404', '404.html'), 404
+
+    return await render_cached(('leaderboard', mode, sort, mods), 'leaderboard.html',
+                               mode=mode, sort=sort, mods=mods)
 
 """ login """
 @frontend.route('/login') # GET
 async def login():
     # if authenticated; render home
-    if 'authenticated' in session:
-        return await flash('error', f'Hey! You\'re already logged in {session["user_data"]["name"]}!', 'home')
+    if user_data := session.get('user_data'):
+        return await flash('error', f'Hey! You\'re already logged in {user_data["name"]}!', 'home')
 
-    return await render_template('login.html')
+    return await render_cached('login', 'login.html')
 @frontend.route('/login', methods=['POST']) # POST
 async def login_post():
     # if authenticated; deny post; return
-    if 'authenticated' in session:
-        return await flash('error', f'Hey! You\'re already logged in {session["user_data"]["name"]}!', 'home')
+    if user_data := session.get('user_data'):
+        return await flash('error', f'Hey! You\'re already logged in {user_data["name"]}!', 'home')
 
-    login_time = time.time_ns() if glob.config.debug else 0
+    login_time = now_ns()
 
     form = await request.form
     username = form.get('username')
@@ -106,48 +212,50 @@ async def login_post():
     # and compare our password input against the database it will fail because the
     # hash saved in the database is invalid.
     if not user_info or user_info['id'] == 1:
-        if glob.config.debug:
-            log(f'{username}\'s login failed - account doesn\'t exist.', Ansi.LYELLOW)
+        log_debug(f'{username}\'s login failed - account doesn\'t exist.', Ansi.LYELLOW)
         return await flash('error', 'Account does not exist.', 'login')
 
     bcrypt_cache = glob.cache['bcrypt']
 
     pw_bcrypt = user_info['pw_bcrypt'].encode()
-    pw_md5 = hashlib.md5(form.get('password').encode()).hexdigest().encode()
+    pw_md5 = hexlify(hashlib.md5(form.get('password').encode(), usedforsecurity=False).digest())
+    pw_tag = bcrypt_cache_tag(pw_md5, user_info['id'])
 
     # check credentials (password) against db
-    # intentionally slow, will cache to speed up
-    if pw_bcrypt in bcrypt_cache:
-        if pw_md5 != bcrypt_cache[pw_bcrypt]: # ~0.1ms
-            if glob.config.debug:
-                log(f'{username}\'s login failed - pw incorrect.', Ansi.LYELLOW)
-            return await flash('error', 'Password is incorrect.', 'login')
-    else: # ~200ms
-        if not bcrypt.checkpw(pw_md5, pw_bcrypt):
-            if glob.config.debug:
-                log(f'{username}\'s login failed - pw incorrect.', Ansi.LYELLOW)
+    # intentionally slow, will cache to speed up.
+    # cached entries are only valid until they expire
+    # or the user's stored bcrypt hash changes.
+    cached = bcrypt_cache.get(pw_tag)
+    if not cached or cached[0] < time.time() or cached[1] != pw_bcrypt: # ~0.1ms
+        loop = asyncio.get_running_loop()
+        executor = _argon2_executor if pw_bcrypt.startswith(b'$argon2') else None
+        if not await loop.run_in_executor(executor, check_pw, pw_md5, pw_bcrypt): # ~200ms
+            bcrypt_cache.pop(pw_tag, None)
+            log_debug(f'{username}\'s login failed - pw incorrect.', Ansi.LYELLOW)
             return await flash('error', 'Password is incorrect.', 'login')
 
         # login successful; cache password for next login
-        bcrypt_cache[pw_bcrypt] = pw_md5
+        bcrypt_cache[pw_tag] = (time.time() + BCRYPT_CACHE_TTL, pw_bcrypt)
+
+        # rehash legacy bcrypt passwords with argon2id in the background
+        if _use_argon2 and not pw_bcrypt.startswith(b'$argon2'):
+            task = asyncio.create_task(upgrade_pw(user_info['id'], pw_md5, pw_tag, pw_bcrypt))
+            _pw_upgrades.add(task)
+            task.add_done_callback(_pw_upgrades.discard)
 
     # user not verified render verify page
     if not user_info['priv'] & Privileges.Verified:
-        if glob.config.debug:
-            log(f'{username}\'s login failed - not verified.', Ansi.LYELLOW)
+        log_debug(f'{username}\'s login failed - not verified.', Ansi.LYELLOW)
         return await render_template('verify.html')
 
     # user banned
     if not user_info['priv'] & Privileges.Normal:
-        if glob.config.debug:
-            log(f'{username}\'s login failed - banned.', Ansi.RED)
+        log_debug(f'{username}\'s login failed - banned.', Ansi.RED)
         return await flash('error', 'You are banned!', 'login')
 
     # login successful; store session data
-    if glob.config.debug:
-        log(f'{username}\'s login succeeded.', Ansi.LGREEN)
+    log_debug(f'{username}\'s login succeeded.', Ansi.LGREEN)
 
-    session['authenticated'] = True
     session['user_data'] = {
         'id': user_info['id'],
         'name': user_info['name'],
@@ -156,32 +264,32 @@ async def login_post():
         'is_staff': user_info['priv'] & Privileges.Staff
     }
 
-    if glob.config.debug:
-        login_time = (time.time_ns() - login_time) / 1e6
+    if _debug:
+        login_time = (now_ns() - login_time) / 1e6
         log(f'Login took {login_time:.2f}ms!', Ansi.LYELLOW)
 
     # authentication successful; redirect home
     return await flash('success', f'Hey! Welcome back {username}!', 'home')
 
 """ registration """
-_username_rgx = re.compile(r'^[\w \[\]-]{2,15}$')
+_username_rgx = re.compile(r'^[\w \[\]-]{2,15}$', re.ASCII)
 _email_rgx = re.compile(r'^[^@\s]{1,200}@[^@\s\.]{1,30}\.[^@\.\s]{1,24}$')
 @frontend.route('/register') # GET
 async def register():
     # if authenticated; redirect home
-    if 'authenticated' in session:
-        return await flash('error', f'Hey! You\'re already registered and logged in {session["user_data"]["name"]}!', 'home')
+    if user_data := session.get('user_data'):
+        return await flash('error', f'Hey! You\'re already registered and logged in {user_data["name"]}!', 'home')
 
     # if registration is disabled; redirect home
     if not glob.config.registration:
         return await flash('error', 'Hey! You can\'t register at this time! Sorry for the inconvenience!', 'home')
     
-    return await render_template('register.html')
+    return await render_cached('register', 'register.html')
 @frontend.route('/register', methods=['POST']) # POST
 async def register_post():
     # if authenticated; deny post; return
-    if 'authenticated' in session:
-        return await flash('error', f'Hey! You\'re already registered and logged in {session["user_data"]["name"]}!', 'home')
+    if user_data := session.get('user_data'):
+        return await flash('error', f'Hey! You\'re already registered and logged in {user_data["name"]}!', 'home')
 
     # if registration is disabled; deny post; return
     if not glob.config.registration:
@@ -190,7 +298,7 @@ async def register_post():
     # get form data (username, email, password)
     form = await request.form
     username = form.get('username')
-    email = form.get('email')
+    email = (form.get('email') or '').strip().lower()
     pw_txt = form.get('password')
 
     # Usernames must:
@@ -199,7 +307,8 @@ async def register_post():
     # - not be in the config's `disallowed_names` list
     # - not already be taken by another player
     # check if username exists
-    if not _username_rgx.match(username):
+    # check length first so oversized input never reaches the regex
+    if not 2 <= len(username) <= 15 or not _username_rgx.match(username):
         return await flash('error', 'Invalid username syntax.', 'register')
 
     if '_' in username and ' ' in username:
@@ -208,16 +317,23 @@ async def register_post():
     if username in glob.config.disallowed_names:
         return await flash('error', 'Disallowed username; pick another.', 'register')
 
-    if await glob.db.fetch('SELECT 1 FROM users WHERE name = %s', username):
-        return await flash('error', 'Username already taken by another user.', 'register')
-
     # Emails must:
     # - match the regex `^[^@\s]{1,200}@[^@\s\.]{1,30}\.[^@\.\s]{1,24}$`
     # - not already be taken by another player
-    if not _email_rgx.match(email):
+    if not 5 <= len(email) <= 256 or not _email_rgx.match(email):
         return await flash('error', 'Invalid email syntax.', 'register')
 
-    if await glob.db.fetch('SELECT 1 FROM users WHERE email = %s', email):
+    # check both username & email availability in one query
+    taken = await glob.db.fetch(
+        'SELECT EXISTS(SELECT 1 FROM users WHERE name = %s) AS name, '
+        'EXISTS(SELECT 1 FROM users WHERE email = %s) AS email',
+        [username, email]
+    )
+
+    if taken['name']:
+        return await flash('error', 'Username already taken by another user.', 'register')
+
+    if taken['email']:
         return await flash('error', 'Email already taken by another user.', 'register')
 
     # Passwords must:
@@ -227,59 +343,91 @@ async def register_post():
     if not 8 < len(pw_txt) <= 32:
         return await flash('error', 'Password must be 8-32 characters in length', 'register')
 
-    if len(set(pw_txt)) <= 3:
+    # count unique characters; for ascii use a bitmask, stopping
+    # as soon as we've seen more than 3 of them.
+    if pw_txt.isascii():
+        seen = unique = 0
+        for c in pw_txt.encode():
+            if not seen & (1 << c):
+                seen |= 1 << c
+                unique += 1
+                if unique > 3:
+                    break
+    else:
+        unique = len(set(pw_txt))
+
+    if unique <= 3:
         return await flash('error', 'Password must have more than 3 unique characters.', 'register')
 
-    if pw_text.lower() in glob.config.disallowed_passwords:
+    if pw_txt.lower() in glob.config.disallowed_passwords:
         return await flash('error', 'That password was deemed too simple.', 'register')
 
-    async with asyncio.Lock():
-        pw_md5 = hashlib.md5(pw_txt.encode()).hexdigest().encode()
-        pw_bcrypt = bcrypt.hashpw(pw_md5, bcrypt.gensalt())
-        glob.cache['bcrypt'][pw_bcrypt] = pw_md5 # cache result for login
-
-        safe_name = get_safe_name(username)
-
-        country = 'xx'
-        if request.remote_addr == '127.0.0.1':
-            country = 'xx'
-        else:
-            match = geolite2.lookup(request.remote_addr)
-            if match:
-                country = match.country.lower()
-
-        # add to `users` table.
-        user_id = await glob.db.execute(
-            'INSERT INTO users '
-            '(name, safe_name, email, pw_bcrypt, country, creation_time, latest_activity) '
-            'VALUES (%s, %s, %s, %s, %s, UNIX_TIMESTAMP(), UNIX_TIMESTAMP())',
-            [username, safe_name, email, pw_bcrypt, country]
-        )
-
-        # add to `stats` table.
-        await glob.db.execute(
-            'INSERT INTO stats '
-            '(id) VALUES (%s)',
-            [user_id]
-        )
-
-    if glob.config.debug:
-        log(f'{username} has registered - awaiting verification.', Ansi.LGREEN)
+    pw_md5 = hexlify(hashlib.md5(pw_txt.encode(), usedforsecurity=False).digest())
+    # hash in a worker thread; password hashing is intentionally
+    # slow and would otherwise block the event loop for every request.
+    loop = asyncio.get_running_loop()
+    executor = _argon2_executor if _use_argon2 else None
+    pw_bcrypt = await loop.run_in_executor(executor, hash_pw, pw_md5)
+
+    safe_name = get_safe_name(username)
+
+    # private & loopback addresses will never
+    # be in the geoip database; skip the lookup.
+    country = 'xx'
+    try:
+        ip = ipaddress.ip_address(request.remote_addr)
+    except ValueError:
+        ip = None
+
+    if ip and not ip.is_private:
+        match = geolite2.lookup(str(ip))
+        if match and match.country:
+            country = match.country.lower()
+
+    # add to `users` & `stats` tables in a single transaction so
+    # we never leave a user without stats. NOTE: this is for crash
+    # safety only; BEGIN/COMMIT make it 4 round trips rather than 2.
+    creation_time = int(time.time())
+    async with glob.db.pool.acquire() as conn:
+        async with conn.cursor() as cursor:
+            await conn.begin()
+            try:
+                await cursor.execute(
+                    'INSERT INTO users '
+                    '(name, safe_name, email, pw_bcrypt, country, creation_time, latest_activity) '
+                    'VALUES (%s, %s, %s, %s, %s, %s, %s)',
+                    [username, safe_name, email, pw_bcrypt, country, creation_time, creation_time]
+                )
+                user_id = cursor.lastrowid
+
+                await cursor.execute(
+                    'INSERT INTO stats '
+                    '(id) VALUES (%s)',
+                    [user_id]
+                )
+            except BaseException: # includes cancellation
+                await conn.rollback()
+                raise
+
+            await conn.commit()
+
+    # cache result for login
+    glob.cache['bcrypt'][bcrypt_cache_tag(pw_md5, user_id)] = (
+        time.time() + BCRYPT_CACHE_TTL, pw_bcrypt
+    )
+
+    log_debug(f'{username} has registered - awaiting verification.', Ansi.LGREEN)
 
     # user has successfully registered
     return await render_template('verify.html')
 
 """ logout """
 @frontend.route('/logout') # GET
-async def logout():
-    if not 'authenticated' in session:
-        return await flash('error', 'You can\'t logout if you aren\'t logged in!', 'login')
-
-    if glob.config.debug:
-        log(f'{session["user_data"]["name"]} logged out.', Ansi.LGREEN)
+@requires_auth('You can\'t logout if you aren\'t logged in!')
+async def logout(user_data):
+    log_debug(f'{user_data["name"]} logged out.', Ansi.LGREEN)
 
     # clear session data
-    session.pop('authenticated', None)
     session.pop('user_data', None)
 
     # render login
@@ -288,12 +436,26 @@ async def logout():
 """ docs """
 @frontend.route('/docs') # GET
 async def docs_nodata():
-    return await render_template('docs.html')
+    return await render_cached('docs', 'docs.html')
 @frontend.route('/doc/<doc>') # GET
 async def docs(doc):
-    async with asyncio.Lock():
-        markdown = markdown2.markdown_path(f'docs/{doc.lower()}.md')
-    return await render_template('doc.html', doc=markdown, doc_title=doc.lower().capitalize())
+    name = doc.lower()
+    path = f'docs/{name}.md'
+
+    try:
+        mtime = os.stat(path).st_mtime
+    except FileNotFoundError:
+        return await render_cached('404', '404.html'), 404
+
+    # only re-parse the markdown when the file has changed;
+    # parsing is cpu-bound so keep it off the event loop.
+    cached = _docs.get(name)
+    if not cached or cached[0] != mtime:
+        loop = asyncio.get_running_loop()
+        markdown = await loop.run_in_executor(None, markdown2.markdown_path, path)
+        _docs[name] = cached = (mtime, markdown)
+
+    return await render_template('doc.html', doc=cached[1], doc_title=name.capitalize())
 
 """ discord redirect """
 @frontend.route('/discord') # GET
@@ -31,6 +31,15 @@ disallowed_passwords = {
     'password', 'minilamp'
 }
 
+# hash new passwords with argon2id instead of bcrypt; existing
+# bcrypt passwords are rehashed when their owner next logs in.
+# NOTE: this requires `users.pw_bcrypt` to be widened (argon2id
+# hashes don't fit in char(60)), and your gulag server must be
+# able to verify argon2id hashes for in-game logins!
+# each argon2id hash uses 64MiB of memory; at most 2 run at
+# once (ARGON2_MAX_WORKERS in blueprints/frontend.py), others queue.
+argon2 = False
+
 # enable registration
 registration = True
 
@@ -4,6 +4,10 @@ from typing import TYPE_CHECKING
 
 import config  # imported for indirect use
 
+# O(1) membership checks for registration
+config.disallowed_names = frozenset(config.disallowed_names)
+config.disallowed_passwords = frozenset(config.disallowed_passwords)
+
 if TYPE_CHECKING:
     from cmyui import AsyncSQLPool, Version
 
@@ -1,15 +1,42 @@
 # -*- coding: utf-8 -*-
 
-from quart import render_template
+import functools
+import hashlib
+import os
+from quart import render_template, session
+
+# per-process key for the bcrypt cache; cache entries
+# never outlive the process so it never needs persisting.
+_bcrypt_cache_key = os.urandom(32)
 
 async def flash(status, msg, template):
     """ Flashes a success/error snackbar message on a specified template. """
     return await render_template(f'{template}.html', flash=msg, status=status)
 
+def requires_auth(msg: str):
+    """ Requires a logged in user, passing their session data as `user_data`. """
+    def decorator(f):
+        @functools.wraps(f)
+        async def wrapper(*args, **kwargs):
+            user_data = session.get('user_data')
+
+            # if not authenticated; render login
+            if not user_data:
+                return await flash('error', msg, 'login')
+
+            return await f(*args, user_data=user_data, **kwargs)
+        return wrapper
+    return decorator
+
 def get_safe_name(name: str) -> str:
     """ Returns the safe version of a username. """
     return name.lower().replace(' ', '_')
 
+def bcrypt_cache_tag(pw_md5: bytes, user_id: int) -> bytes:
+    """ Returns the keyed bcrypt cache tag for a user's password. """
+    return hashlib.blake2b(pw_md5 + user_id.to_bytes(4, 'little'),
+                           digest_size=16, key=_bcrypt_cache_key).digest()
+
 def convert_mode_int(mode: str) -> int:
     """ Converts mode (str) to mode (int). """
     if mode == 'std':